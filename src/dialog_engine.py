@@ -1,51 +1,97 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
 import re
-from dataclasses import dataclass
-from typing import List, Optional, Sequence, Tuple
-
-from openai import OpenAI
-
+import string
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, List, Optional, Tuple
+
+from env_loader import load_dotenv_once
+from openai_client import TRANSIENT_ERRORS, async_client, ensure_api_key, retrying_while, with_retry
+from sentence_splitter import split_sentences
 from tts_engine import synthesize_speech
 
-History = List[Tuple[str, str]]
-
-
-def _load_dotenv_if_present(dotenv_path: str = ".env") -> None:
-    """
-    Minimal .env loader:
-    - reads KEY=VALUE lines
-    - ignores blank lines and comments (#)
-    - does not override already-set environment variables
-    """
-    if not os.path.exists(dotenv_path):
-        return
+# История диалога в виде готовых сообщений OpenAI: прошлые реплики не меняются,
+# поэтому сериализуем каждую один раз при добавлении.
+History = List[dict]
+# (спикер, текст) — для транскрипта на диске
+Transcript = List[Tuple[str, str]]
+# Колбэк для готовых предложений реплики: (номер предложения с 1, текст)
+SentenceCallback = Callable[[int, str], None]
+
+
+load_dotenv_once()
+
+# Проверка на латиницу без regex: пересечение множества символов текста с A–Z, a–z.
+LATIN_LETTERS = frozenset(string.ascii_letters)
+
+# 1 = при латинице в реплике просить модель переписать текст (лишний запрос к API),
+# иначе латиница заменяется детерминированно: известные термины + побуквенная транслитерация.
+STRICT_LLM_REWRITE = os.getenv("STRICT_LLM_REWRITE", "0").strip().lower() in {"1", "true", "yes", "y", "on"}
+
+_LATIN_TO_CYRILLIC = {
+    "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф", "g": "г",
+    "h": "х", "i": "и", "j": "дж", "k": "к", "l": "л", "m": "м", "n": "н",
+    "o": "о", "p": "п", "q": "к", "r": "р", "s": "с", "t": "т", "u": "у",
+    "v": "в", "w": "в", "x": "кс", "y": "и", "z": "з",
+}
+TRANSLIT = str.maketrans(
+    {
+        **_LATIN_TO_CYRILLIC,
+        **{lat.upper(): cyr.capitalize() for lat, cyr in _LATIN_TO_CYRILLIC.items()},
+    }
+)
 
-    try:
-        with open(dotenv_path, "r", encoding="utf-8") as f:
-            for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                key, value = line.split("=", 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                if key and key not in os.environ:
-                    os.environ[key] = value
-    except OSError:
-        return
-
-
-_load_dotenv_if_present()
-client = OpenAI()
-
-LATIN_RE = re.compile(r"[A-Za-z]")
+# Термины, для которых побуквенная транслитерация звучит плохо: заменяем целиком.
+KNOWN_LATIN_TERMS = {
+    "DNA": "ДНК",
+    "RNA": "РНК",
+    "mRNA": "мРНК",
+    "ATP": "АТФ",
+    "NAD": "НАД",
+    "NAD+": "НАД+",
+    "PCR": "ПЦР",
+    "HIV": "ВИЧ",
+    "MRI": "МРТ",
+    "AI": "ИИ",
+    "CRISPR": "КРИСПР",
+    "COVID": "ковид",
+}
+KNOWN_LATIN_TERMS_RE = re.compile(
+    r"\b(?:"
+    + "|".join(re.escape(t) for t in sorted(KNOWN_LATIN_TERMS, key=len, reverse=True))
+    + r")(?![A-Za-z])"
+)
 IRINA_NAME = "Д-р Ирина (учёный)"
 IRINA_FIRST_PHRASE = "Давай начнём с самого простого."
 
 # Пролог перед первой фразой Ирины (только в самом первом ходе)
 IRINA_PREFACE = "Добрый день. Да, спасибо."
+# Начало первой реплики Ирины — фиксированный текст, модель пишет только продолжение.
+IRINA_OPENING = f"{IRINA_PREFACE} {IRINA_FIRST_PHRASE}"
+
+# Реплика — 2–4 предложения, больший запас токенов только удлиняет хвост задержки.
+REPLY_MAX_TOKENS = 180
+# Продолжение первой реплики Ирины короче: часть реплики уже занимает IRINA_OPENING.
+IRINA_CONTINUATION_MAX_TOKENS = 140
+REWRITE_MAX_TOKENS = 200
+
+# Знаки, которыми заканчивается законченное предложение.
+SENTENCE_END_CHARS = (".", "!", "?", "…")
+
+# Не даём модели начать следующую реплику за другого персонажа.
+STOP_SEQUENCES = ["\nД-р Ирина", "\nД-р Алексей", "\nИрина:", "\nАлексей:"]
+
+# Ограничение на число одновременных TTS-запросов (чтобы не упираться в лимиты RPM/TPM).
+TTS_CONCURRENCY = 5
+
+VOICE_MAP = {
+    IRINA_NAME: "nova",
+    "Д-р Алексей (скептик)": "alloy",
+}
 
 
 # Убираем только если это стоит СТРОГО в начале реплики (не трогаем середину текста).
@@ -55,36 +101,80 @@ SPEAKER_PREFIX_RE = re.compile(
 )
 
 
+COMMON_RULES = (
+    "Общие правила:\n"
+    "- Отвечай строго на русском.\n"
+    "- 2–4 предложения.\n"
+    "- Научно, но понятно, без сухого академизма.\n"
+    "- ЖЁСТКИЙ ЗАПРЕТ: никаких английских слов, вставок, транслитерации, латиницы.\n"
+    "- Не пиши своё имя и должность в начале реплики, говори просто от первого лица.\n"
+    "- Вопросы не должны занимать весь объём реплики: сначала мысль/позиция, затем (если уместно) 1 прицельный вопрос.\n"
+    "- Ирина чаще утверждает и объясняет; Алексей чаще задаёт вопросы и сомневается.\n"
+)
+
+
+REWRITE_RULE = (
+    "ЖЁСТКОЕ ПРАВИЛО: в ответе не должно быть НИ ОДНОЙ латинской буквы (A–Z, a–z). "
+    "Никаких английских слов, вставок, транслитерации. Только кириллица, цифры и знаки."
+)
+
+
+def _prompt_cache_key(system_content: str) -> str:
+    digest = hashlib.blake2b(system_content.encode("utf-8"), digest_size=8).hexdigest()
+    return f"ai-avatar-stream-{digest}"
+
+
 @dataclass(frozen=True)
 class Agent:
     name: str
     system_prompt: str
+    # system_prompt + общие правила; собирается один раз при создании агента,
+    # чтобы system-сообщение было побайтно одинаковым во всех запросах агента.
+    system_prompt_full: str = field(init=False)
+    # Ключ кэша префиксов на стороне OpenAI: один на агента и стабилен между запусками,
+    # пока не меняется его system-сообщение.
+    prompt_cache_key: str = field(init=False)
+    # У запроса на переписывание без латиницы свой system-префикс — и свой ключ кэша.
+    rewrite_system_prompt: str = field(init=False)
+    rewrite_prompt_cache_key: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        system_prompt_full = f"{self.system_prompt}\n\n{COMMON_RULES}"
+        rewrite_system_prompt = f"{self.system_prompt}\n\n{REWRITE_RULE}"
+        object.__setattr__(self, "system_prompt_full", system_prompt_full)
+        object.__setattr__(self, "prompt_cache_key", _prompt_cache_key(system_prompt_full))
+        object.__setattr__(self, "rewrite_system_prompt", rewrite_system_prompt)
+        object.__setattr__(self, "rewrite_prompt_cache_key", _prompt_cache_key(rewrite_system_prompt))
+
+
+@with_retry
+async def _create_chat_completion(**kwargs):
+    return await async_client.chat.completions.create(**kwargs)
+
 
+def _has_latin(text: str) -> bool:
+    return not LATIN_LETTERS.isdisjoint(text)
 
-def _history_to_messages(history: Sequence[Tuple[str, str]]) -> List[dict]:
-    messages: List[dict] = []
-    for speaker, text in history:
-        messages.append({"role": "user", "content": f"{speaker}: {text}".strip()})
-    return messages
 
+def _to_message(speaker: str, text: str) -> dict:
+    return {"role": "user", "content": f"{speaker}: {text}".strip()}
 
-def _rewrite_without_latin(text: str, agent: Agent) -> str:
+
+def _transliterate(text: str) -> str:
     """
-    Если в реплике проскочила латиница — просим модель переписать СТРОГО без латинских букв.
-    Делаем 1 попытку, чтобы не зациклиться.
+    Убирает латиницу без обращения к модели: сначала известные термины, затем побуквенно.
     """
-    if not LATIN_RE.search(text):
-        return text
+    text = KNOWN_LATIN_TERMS_RE.sub(lambda m: KNOWN_LATIN_TERMS[m.group(0)], text)
+    return text.translate(TRANSLIT)
 
+
+async def _rewrite_without_latin_llm(text: str, agent: Agent) -> str:
+    """
+    Просим модель переписать текст СТРОГО без латинских букв.
+    Делаем 1 попытку, чтобы не зациклиться.
+    """
     messages = [
-        {
-            "role": "system",
-            "content": (
-                f"{agent.system_prompt}\n\n"
-                "ЖЁСТКОЕ ПРАВИЛО: в ответе не должно быть НИ ОДНОЙ латинской буквы (A–Z, a–z). "
-                "Никаких английских слов, вставок, транслитерации. Только кириллица, цифры и знаки."
-            ),
-        },
+        {"role": "system", "content": agent.rewrite_system_prompt},
         {
             "role": "user",
             "content": (
@@ -94,73 +184,67 @@ def _rewrite_without_latin(text: str, agent: Agent) -> str:
         },
     ]
 
-    resp = client.chat.completions.create(
+    resp = await _create_chat_completion(
         model="gpt-4o-mini",
         messages=messages,
-        max_tokens=260,
+        prompt_cache_key=agent.rewrite_prompt_cache_key,
+        max_tokens=REWRITE_MAX_TOKENS,
         temperature=0.3,
     )
-    rewritten = (resp.choices[0].message.content or "").strip()
-    # На всякий случай: если всё равно есть латиница — просто возвращаем оригинал без второй попытки
-    return rewritten if not LATIN_RE.search(rewritten) else text
+    return (resp.choices[0].message.content or "").strip()
 
 
-def _strip_leading_speaker_prefix(reply: str) -> str:
+async def _rewrite_without_latin(text: str, agent: Agent) -> str:
     """
-    Убираем "Д-р Ирина (учёный):" / "Д-р Алексей (скептик):" если это случайно попало в НАЧАЛО реплики.
+    Если в реплике проскочила латиница — убираем её.
+    По умолчанию транслитерацией (без второго запроса к API), при STRICT_LLM_REWRITE=1 — через модель.
     """
-    cleaned = reply.lstrip()
-    cleaned = SPEAKER_PREFIX_RE.sub("", cleaned).strip()
-    return cleaned
+    if not _has_latin(text):
+        return text
 
+    if STRICT_LLM_REWRITE:
+        rewritten = await _rewrite_without_latin_llm(text, agent)
+        if rewritten and not _has_latin(rewritten):
+            return rewritten
 
-def _enforce_irina_first_phrase(reply: str) -> str:
-    """
-    Гарантируем, что первая реплика Ирины начинается с нужной фразы.
-    """
-    cleaned = reply.lstrip()
-    if cleaned.startswith(IRINA_FIRST_PHRASE):
-        return cleaned
-    return f"{IRINA_FIRST_PHRASE} {cleaned}".strip()
+    # Если модель не справилась (или не вызывалась) — транслитерация гарантирует отсутствие латиницы
+    return _transliterate(text)
 
 
-def _add_irina_preface_if_first_turn(reply: str) -> str:
+def _strip_leading_speaker_prefix(reply: str) -> str:
     """
-    Добавляем пролог перед обязательной первой фразой Ирины:
-    "Добрый день. Да, спасибо. Давай начнём с самого простого. ..."
-    Делается только если реплика уже начинается с IRINA_FIRST_PHRASE.
+    Убираем "Д-р Ирина (учёный):" / "Д-р Алексей (скептик):" если это случайно попало в НАЧАЛО реплики.
     """
-    cleaned = reply.lstrip()
-    if not cleaned.startswith(IRINA_FIRST_PHRASE):
-        return cleaned
-    # уже с прологом? (на всякий случай, чтобы не задвоить)
-    if cleaned.startswith(f"{IRINA_PREFACE} {IRINA_FIRST_PHRASE}"):
-        return cleaned
-    return f"{IRINA_PREFACE} {cleaned}".strip()
+    return SPEAKER_PREFIX_RE.sub("", reply, count=1).strip()
 
 
-def generate_reply(
+async def generate_reply(
     agent: Agent,
     history: History,
     topic: Optional[str] = None,
-    max_tokens: int = 350,
-) -> Tuple[str, History]:
-    if not os.getenv("OPENAI_API_KEY"):
-        raise RuntimeError(
-            "Не найден OPENAI_API_KEY. Создайте файл .env в корне проекта и добавьте строку "
-            "OPENAI_API_KEY=ваш_ключ (или задайте переменную окружения OPENAI_API_KEY)."
-        )
+    max_tokens: int = REPLY_MAX_TOKENS,
+    on_sentence: Optional[SentenceCallback] = None,
+) -> str:
+    """
+    Генерирует реплику потоково: каждое законченное предложение сразу проходит
+    пост-обработку и передаётся в on_sentence, не дожидаясь конца ответа модели.
+    """
+    ensure_api_key()
 
     is_first_turn = not history
     effective_topic = topic if is_first_turn else None
     topic_line = f"Тема: {effective_topic}." if effective_topic else ""
 
-    if is_first_turn and agent.name == IRINA_NAME:
+    is_irina_opening = is_first_turn and agent.name == IRINA_NAME
+
+    if is_irina_opening:
+        max_tokens = min(max_tokens, IRINA_CONTINUATION_MAX_TOKENS)
         user_content = (
             "Сделай ПЕРВУЮ реплику диалога по указанной теме.\n"
             "Это самое начало: до этого никто ничего не говорил.\n"
-            f"Реплика ОБЯЗАТЕЛЬНО начинается ровно с фразы: «{IRINA_FIRST_PHRASE}».\n"
-            "Дальше — спокойное, уверенное введение в тему (2–4 предложения), без ощущения, что спор уже идёт.\n"
+            f"Реплика уже начата фразой: «{IRINA_OPENING}».\n"
+            "Напиши ТОЛЬКО её продолжение, не повторяя эту фразу: "
+            "спокойное, уверенное введение в тему (2–3 предложения), без ощущения, что спор уже идёт.\n"
             "Ирина — эксперт: она объясняет и ведёт разговор.\n"
             "Не используй английские слова, вставки и латиницу.\n"
             "Не перечисляй правила и не используй разметку."
@@ -177,48 +261,144 @@ def generate_reply(
     messages: List[dict] = [
         {
             "role": "system",
-            "content": (
-                f"{agent.system_prompt}\n\n"
-                "Общие правила:\n"
-                "- Отвечай строго на русском.\n"
-                "- 2–4 предложения.\n"
-                "- Научно, но понятно, без сухого академизма.\n"
-                "- ЖЁСТКИЙ ЗАПРЕТ: никаких английских слов, вставок, транслитерации, латиницы.\n"
-                "- Не пиши своё имя и должность в начале реплики, говори просто от первого лица.\n"
-                "- Вопросы не должны занимать весь объём реплики: сначала мысль/позиция, затем (если уместно) 1 прицельный вопрос.\n"
-                "- Ирина чаще утверждает и объясняет; Алексей чаще задаёт вопросы и сомневается.\n"
-                f"{topic_line}"
-            ).strip(),
+            "content": f"{agent.system_prompt_full}{topic_line}".strip(),
         },
-        *_history_to_messages(history),
+        *history,
         {"role": "user", "content": user_content},
     ]
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=0.7,
-    )
+    sentences: List[str] = []
+    model_started = False
+
+    def _publish(sentence: str) -> None:
+        sentences.append(sentence)
+        if on_sentence is not None:
+            on_sentence(len(sentences), sentence)
+
+    async def _emit(raw_sentence: str) -> None:
+        nonlocal model_started
+        sentence = raw_sentence.strip()
+
+        # Пост-обработка касается только начала ответа модели (первого непустого предложения)
+        if not model_started:
+            # Косметика: убираем "Д-р Ирина...:", если попало в начало реплики
+            sentence = _strip_leading_speaker_prefix(sentence)
+            # Модель всё-таки повторила фиксированное начало — не дублируем его
+            if is_irina_opening and sentence in IRINA_OPENING:
+                return
+
+        if not sentence:
+            return
+
+        model_started = True
+        _publish(await _rewrite_without_latin(sentence, agent))
+
+    # Фиксированное начало первой реплики Ирины отдаём сразу, не дожидаясь модели
+    if is_irina_opening:
+        _publish(IRINA_OPENING)
+
+    async def _stream_model_reply() -> None:
+        stream = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            stop=STOP_SEQUENCES,
+            stream=True,
+            prompt_cache_key=agent.prompt_cache_key,
+        )
 
-    reply_text = (resp.choices[0].message.content or "").strip()
+        buffer = ""
+        finish_reason: Optional[str] = None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            buffer += choice.delta.content or ""
+            # Последний кусок — незаконченное предложение, остаётся в буфере
+            complete, buffer = split_sentences(buffer)
+            for sentence in complete:
+                await _emit(sentence)
+
+        # Ответ упёрся в max_tokens: хвост без знака конца предложения — обрубок.
+        # Отбрасываем его, только если от модели уже есть законченные предложения,
+        # иначе реплика осталась бы пустой.
+        tail = buffer.strip()
+        truncated = finish_reason == "length" and tail and not tail.endswith(SENTENCE_END_CHARS)
+        if truncated and model_started:
+            print(f"[DIALOG][WARN] Реплика обрезана по max_tokens, хвост отброшен: {tail}")
+            return
+        await _emit(buffer)
+
+    # Сбой до первого предложения модели (в том числе обрыв посреди потока) — повторяем ход целиком.
+    # Если предложения уже ушли в озвучку, повтор их бы задублировал: завершаем реплику тем, что есть.
+    try:
+        async for attempt in retrying_while(lambda: not model_started):
+            with attempt:
+                await _stream_model_reply()
+    except TRANSIENT_ERRORS as e:
+        if not model_started:
+            raise
+        print(f"[DIALOG][WARN] Поток ответа оборвался, реплика укорочена ({agent.name}): {e}")
+
+    return " ".join(sentences)
+
+
+async def _synthesize_sentence(
+    semaphore: asyncio.Semaphore,
+    text: str,
+    speaker: str,
+    turn_index: int,
+    sentence_index: int,
+    voice: str,
+) -> None:
+    async with semaphore:
+        try:
+            audio_path = await synthesize_speech(
+                text=text,
+                speaker=speaker,
+                turn_index=turn_index,
+                voice=voice,
+                sentence_index=sentence_index,
+                # Кэшируем только фиксированное начало, реплики модели не повторяются
+                use_cache=text == IRINA_OPENING,
+            )
+            print(f"[AUDIO] Сохранён файл: {audio_path}")
+        except Exception as e:
+            print(
+                f"[AUDIO][ERROR] Не удалось озвучить реплику {turn_index}, "
+                f"предложение {sentence_index}: {e}"
+            )
 
-    # Косметика: убираем "Д-р Ирина...:", если попало в начало реплики
-    reply_text = _strip_leading_speaker_prefix(reply_text)
 
-    # "Гарантии качества"
-    if is_first_turn and agent.name == IRINA_NAME:
-        reply_text = _enforce_irina_first_phrase(reply_text)
-        reply_text = _add_irina_preface_if_first_turn(reply_text)
+def _enqueue_sentence(
+    queue: asyncio.Queue,
+    speaker: str,
+    turn_index: int,
+    voice: str,
+    sentence_index: int,
+    text: str,
+) -> None:
+    queue.put_nowait((text, speaker, turn_index, sentence_index, voice))
 
-    reply_text = _rewrite_without_latin(reply_text, agent)
 
-    updated_history: History = list(history)
-    updated_history.append((agent.name, reply_text))
-    return reply_text, updated_history
+async def _tts_worker(queue: asyncio.Queue) -> None:
+    """
+    Потребитель очереди предложений: озвучивает их параллельно с генерацией диалога.
+    None в очереди — сигнал, что новых предложений не будет.
+    """
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+    tasks: List[asyncio.Task] = []
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        tasks.append(asyncio.create_task(_synthesize_sentence(semaphore, *item)))
+    await asyncio.gather(*tasks)
 
 
-def run_dialog(topic: str, turns: int = 10) -> History:
+async def run_dialog_async(topic: str, turns: int = 10) -> Transcript:
     agent1 = Agent(
         name=IRINA_NAME,
         system_prompt=(
@@ -247,31 +427,39 @@ def run_dialog(topic: str, turns: int = 10) -> History:
     )
 
     history: History = []
+    transcript: Transcript = []
     agents = [agent1, agent2]
 
-    voice_map = {
-        IRINA_NAME: "nova",
-        "Д-р Алексей (скептик)": "alloy",
-    }
-
-    for i in range(turns):
-        agent = agents[i % 2]
-        reply, history = generate_reply(agent=agent, history=history, topic=topic)
-        print(f"{agent.name}: {reply}\n")
+    queue: asyncio.Queue = asyncio.Queue()
+    worker = asyncio.create_task(_tts_worker(queue))
 
-        try:
-            voice = voice_map.get(agent.name, "alloy")
-            audio_path = synthesize_speech(
-                text=reply,
-                speaker=agent.name,
-                turn_index=i + 1,
-                voice=voice,
+    try:
+        for i in range(turns):
+            agent = agents[i % 2]
+            voice = VOICE_MAP.get(agent.name, "alloy")
+            reply = await generate_reply(
+                agent=agent,
+                history=history,
+                topic=topic,
+                on_sentence=partial(_enqueue_sentence, queue, agent.name, i + 1, voice),
             )
-            print(f"[AUDIO] Сохранён файл: {audio_path}")
-        except Exception as e:
-            print(f"[AUDIO][ERROR] Не удалось озвучить реплику: {e}")
-
-    return history
+            if not reply:
+                print(f"[DIALOG][WARN] Пустая реплика ({agent.name}), ход {i + 1} пропущен")
+                continue
+            history.append(_to_message(agent.name, reply))
+            transcript.append((agent.name, reply))
+            print(f"{agent.name}: {reply}\n")
+    finally:
+        # Дожидаемся озвучки всего, что уже успели сгенерировать
+        queue.put_nowait(None)
+        print("[AUDIO] Дожидаемся озвучки реплик...")
+        await worker
+
+    return transcript
+
+
+def run_dialog(topic: str, turns: int = 10) -> Transcript:
+    return asyncio.run(run_dialog_async(topic=topic, turns=turns))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+
+# Корень проекта: на уровень выше папки src.
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+_LOADED = False
+
+
+def load_dotenv_once(dotenv_name: str = ".env") -> None:
+    """
+    Минималистичный загрузчик .env (файл читается один раз за процесс):
+    - ищет .env в корне проекта
+    - читает строки KEY=VALUE
+    - игнорирует пустые строки и комментарии (#)
+    - не перезаписывает уже выставленные переменные окружения
+    """
+    global _LOADED
+    if _LOADED:
+        return
+    _LOADED = True
+
+    try:
+        lines = (PROJECT_ROOT / dotenv_name).read_text(encoding="utf-8").splitlines()
+    except OSError:
+        # Нет файла или не получилось прочитать — просто пропускаем
+        return
+
+    for raw_line in lines:
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        key = key.strip()
+        value = value.strip().strip('"').strip("'")
+        if key and key not in os.environ:
+            os.environ[key] = value
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
+import asyncio
 import os
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
 
-from dialog_engine import run_dialog
+from dialog_engine import Transcript, run_dialog_async
+from env_loader import load_dotenv_once
+from tts_engine import synthesize_to_file
 import video_engine
 
 
@@ -14,33 +17,6 @@ LOGS_DIR = PROJECT_ROOT / "logs"
 AUDIO_DIR = PROJECT_ROOT / "audio"
 
 
-def _load_dotenv_if_present(dotenv_name: str = ".env") -> None:
-    """
-    Минималистичный загрузчик .env:
-    - ищет файл .env в корне проекта
-    - читает строки KEY=VALUE
-    - игнорирует пустые строки и комментарии (#)
-    - не перезаписывает уже выставленные переменные окружения
-    """
-    env_path = PROJECT_ROOT / dotenv_name
-    if not env_path.exists():
-        return
-
-    try:
-        with env_path.open("r", encoding="utf-8") as f:
-            for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                key, value = line.split("=", 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                if key and key not in os.environ:
-                    os.environ[key] = value
-    except OSError:
-        return
-
-
 def _env_int(name: str, default: int) -> int:
     try:
         return int(os.getenv(name, str(default)))
@@ -72,8 +48,36 @@ def _clean_audio_dir() -> None:
             pass
 
 
+async def _prebuild_intros(topic: str) -> None:
+    """
+    Озвучивает интро темы и представления спикеров, пока генерируется диалог.
+    Ошибки не фатальны: video_engine при необходимости озвучит интро сам.
+    """
+    jobs = video_engine.intro_audio_jobs(topic)
+    results = await asyncio.gather(
+        *(
+            synthesize_to_file(text=text, output_path=out_path, voice=video_engine.NEUTRAL_VOICE)
+            for text, out_path in jobs
+        ),
+        return_exceptions=True,
+    )
+    for (_, out_path), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            print(f"[INTRO][WARN] Не удалось заранее озвучить {out_path.name}: {result}")
+        else:
+            print(f"[INTRO] Озвучено заранее: {out_path.name}")
+
+
+async def _generate(topic: str, turns: int) -> Transcript:
+    intros = asyncio.create_task(_prebuild_intros(topic))
+    try:
+        return await run_dialog_async(topic=topic, turns=turns)
+    finally:
+        await intros
+
+
 def main() -> None:
-    _load_dotenv_if_present()
+    load_dotenv_once()
 
     # Настройки (через .env)
     topic: str = os.getenv(
@@ -97,7 +101,7 @@ def main() -> None:
     print(f"[MAIN] TURNS: {turns}")
     print(f"[MAIN] Transcript: {transcript_path}")
 
-    history = run_dialog(topic=topic, turns=turns)
+    history = asyncio.run(_generate(topic=topic, turns=turns))
     _write_transcript(history=history, out_path=transcript_path)
     print(f"[OK] Транскрипт сохранён: {transcript_path}")
 
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import os
+from typing import Callable
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from tenacity import (
+    AsyncRetrying,
+    retry,
+    retry_if_exception,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from env_loader import load_dotenv_once
+
+
+# Загружаем .env ПЕРЕД созданием клиентов OpenAI (нужен OPENAI_API_KEY)
+load_dotenv_once()
+
+
+def ensure_api_key() -> None:
+    """
+    Проверяем, что ключ API доступен в переменных окружения.
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        raise RuntimeError(
+            "Не найден OPENAI_API_KEY. Создайте файл .env в корне проекта и добавьте строку "
+            "OPENAI_API_KEY=ваш_ключ (или задайте переменную окружения OPENAI_API_KEY)."
+        )
+
+
+# Общие настройки пула соединений: за запуск идёт ~2N запросов (реплики + озвучка),
+# поэтому держим соединения открытыми и не повторяем TCP/TLS-рукопожатия.
+_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60)
+_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+# Один синхронный и один асинхронный клиент на весь процесс.
+# Встроенные повторы SDK выключены: повторами управляет with_retry.
+client = OpenAI(
+    http_client=DefaultHttpxClient(limits=_LIMITS, timeout=_TIMEOUT),
+    max_retries=0,
+)
+async_client = AsyncOpenAI(
+    http_client=DefaultAsyncHttpxClient(limits=_LIMITS, timeout=_TIMEOUT),
+    max_retries=0,
+)
+
+# Повтор с экспоненциальной паузой только для временных ошибок:
+# сеть/таймаут, 429 (лимиты) и 5xx. Ошибки запроса (400, 401, ...) не повторяем.
+# httpx.TransportError — обрыв соединения уже во время чтения потокового ответа
+# (SDK оборачивает в APIConnectionError только ошибки при отправке запроса).
+TRANSIENT_ERRORS = (
+    APIConnectionError,
+    APITimeoutError,
+    RateLimitError,
+    InternalServerError,
+    httpx.TransportError,
+)
+_RETRY_WAIT = wait_exponential(multiplier=1, max=30)
+_RETRY_STOP = stop_after_attempt(5)
+
+with_retry = retry(
+    retry=retry_if_exception_type(TRANSIENT_ERRORS),
+    wait=_RETRY_WAIT,
+    stop=_RETRY_STOP,
+    reraise=True,
+)
+
+
+def retrying_while(can_retry: Callable[[], bool]) -> AsyncRetrying:
+    """
+    Та же политика, что у with_retry, но повтор разрешён, только пока can_retry() истинно
+    (например, пока из потокового ответа ещё ничего не ушло дальше).
+    """
+    return AsyncRetrying(
+        retry=retry_if_exception_type(TRANSIENT_ERRORS) & retry_if_exception(lambda _: can_retry()),
+        wait=_RETRY_WAIT,
+        stop=_RETRY_STOP,
+        reraise=True,
+    )
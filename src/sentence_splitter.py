@@ -0,0 +1,22 @@
+from __future__ import annotations
+
+import re
+from typing import List, Tuple
+
+# Граница предложения в потоке токенов:
+# - знак конца предложения, пробел и начало нового предложения (заглавная буква, цифра, кавычка, тире...);
+#   поэтому сокращения вида "т. е.", "и т. д.", "см. рис." не режут предложение;
+# - точка после одиночной заглавной буквы (инициалы "И. И. Мечников") границей не считается;
+# - перевод строки — всегда граница.
+SENTENCE_END_RE = re.compile(
+    r"(?<=[.!?…])(?<!\b[А-ЯЁA-Z]\.)\s+(?=[«\"'(\-—–А-ЯЁA-Z0-9])|\n+"
+)
+
+
+def split_sentences(buffer: str) -> Tuple[List[str], str]:
+    """
+    Делит накопленный текст на законченные предложения и незаконченный хвост.
+    Хвост остаётся в буфере до прихода следующих токенов.
+    """
+    *complete, rest = SENTENCE_END_RE.split(buffer)
+    return complete, rest
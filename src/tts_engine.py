@@ -1,108 +1,276 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
+import shutil
+from collections import OrderedDict
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
-from openai import OpenAI
+from env_loader import load_dotenv_once
+from openai_client import async_client, client, ensure_api_key, with_retry
 
 
-# --- Загрузка .env ЛОКАЛЬНО для этого модуля ---
+load_dotenv_once()
 
+# Корень проекта: на уровень выше папки src.
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+# Папка для аудиофайлов.
+AUDIO_DIR = PROJECT_ROOT / "audio"
+# Кэш уже озвученных текстов: ключ — хэш (модель, голос, текст).
+# Только для фиксированных текстов (интро, начало первой реплики): реплики модели
+# почти не повторяются, и их кэширование только раздувало бы папку.
+TTS_CACHE_DIR = AUDIO_DIR / ".cache"
+
+TTS_MODEL = "gpt-4o-mini-tts"
+
+# Аудио, уже озвученное в этом процессе: (голос, текст) -> mp3.
+# Как и кэш на диске — только для фиксированных текстов, чтобы реплики не вытесняли интро.
+# LRU с ограничением и по числу записей, и по суммарному размеру.
+TTS_MEMO_MAX_ITEMS = 256
+TTS_MEMO_MAX_BYTES = 32 * 1024 * 1024
 
-def _load_dotenv_if_present(dotenv_name: str = ".env") -> None:
+_tts_memo: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+_tts_memo_bytes = 0
+# Запросы к TTS, которые выполняются прямо сейчас: одинаковые тексты ждут один и тот же запрос.
+_tts_inflight: Dict[Tuple[str, str], "asyncio.Task[bytes]"] = {}
+
+
+# Символы, которые убираются из имени диктора (пробелы и скобки).
+_SIMPLIFY_TBL = str.maketrans("", "", " ()[]{}")
+
+
+def _simplify_speaker_name(speaker: str) -> str:
     """
-    Минималистичный загрузчик .env:
-    - ищет файл .env в корне проекта (на уровень выше src)
-    - читает строки KEY=VALUE
-    - не перезаписывает уже выставленные переменные окружения
+    Упрощает имя диктора для использования в имени файла:
+    - приводит к нижнему регистру
+    - убирает пробелы и скобки
     """
-    # Корень проекта: на уровень выше папки src.
-    project_root = Path(__file__).resolve().parent.parent
-    env_path = project_root / dotenv_name
+    # На всякий случай, если имя полностью "стерлось"
+    return speaker.lower().translate(_SIMPLIFY_TBL) or "speaker"
+
 
-    if not env_path.exists():
+def _tts_cache_path(text: str, voice: str) -> Path:
+    key = hashlib.blake2b(f"{TTS_MODEL}|{voice}|{text}".encode("utf-8"), digest_size=16).hexdigest()
+    return TTS_CACHE_DIR / f"{key}.mp3"
+
+
+def get_from_tts_memo(text: str, voice: str) -> Optional[bytes]:
+    data = _tts_memo.get((voice, text))
+    if data is not None:
+        _tts_memo.move_to_end((voice, text))
+    return data
+
+
+def put_in_tts_memo(text: str, voice: str, data: bytes) -> None:
+    global _tts_memo_bytes
+    key = (voice, text)
+    old = _tts_memo.pop(key, None)
+    if old is not None:
+        _tts_memo_bytes -= len(old)
+    if len(data) > TTS_MEMO_MAX_BYTES:
         return
+    _tts_memo[key] = data
+    _tts_memo_bytes += len(data)
+    # Вытесняем самые давно использованные записи
+    while len(_tts_memo) > TTS_MEMO_MAX_ITEMS or _tts_memo_bytes > TTS_MEMO_MAX_BYTES:
+        _, evicted = _tts_memo.popitem(last=False)
+        _tts_memo_bytes -= len(evicted)
+
 
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """
+    Жёсткая ссылка вместо копии (без лишнего чтения/записи данных);
+    копируем, только если ссылку создать нельзя (другой диск, ФС без ссылок).
+    """
     try:
-        with env_path.open("r", encoding="utf-8") as f:
-            for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-
-                key, value = line.split("=", 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-
-                # Не трогаем уже выставленные переменные
-                if key and key not in os.environ:
-                    os.environ[key] = value
+        os.link(src, dst)
     except OSError:
-        # Если не получилось прочитать файл — просто пропускаем
-        return
+        shutil.copyfile(src, dst)
 
 
-# Загружаем .env ПЕРЕД созданием клиента OpenAI
-_load_dotenv_if_present()
-
+def release_output_path(output_path: Path) -> None:
+    """
+    Убирает старый файл перед записью нового аудио.
+    Файл может быть жёсткой ссылкой на запись кэша — запись поверх испортила бы кэш.
+    """
+    output_path.unlink(missing_ok=True)
 
-# Создаём глобальный клиент OpenAI (использует OPENAI_API_KEY из переменных окружения).
-client = OpenAI()
 
-# Корень проекта: на уровень выше папки src.
-PROJECT_ROOT = Path(__file__).resolve().parent.parent
-# Папка для аудиофайлов.
-AUDIO_DIR = PROJECT_ROOT / "audio"
+def write_audio_file(output_path: Path, data: bytes) -> None:
+    release_output_path(output_path)
+    output_path.write_bytes(data)
 
 
-def _simplify_speaker_name(speaker: str) -> str:
+def restore_from_tts_cache(text: str, voice: str, output_path: Path) -> bool:
     """
-    Упрощает имя диктора для использования в имени файла:
-    - приводит к нижнему регистру
-    - убирает пробелы и скобки
+    Если этот текст этим голосом уже озвучивался — ставит mp3 из кэша на место output_path.
+    Возвращает True при попадании в кэш.
     """
-    simplified = speaker.lower()
-    for ch in (" ", "(", ")", "[", "]", "{", "}"):
-        simplified = simplified.replace(ch, "")
-    # На всякий случай, если имя полностью "стерлось"
-    return simplified or "speaker"
+    cache_path = _tts_cache_path(text, voice)
+    if not cache_path.exists():
+        return False
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    release_output_path(output_path)
+    _link_or_copy(cache_path, output_path)
+    return True
 
 
-def synthesize_speech(text: str, speaker: str, turn_index: int, voice: str = "alloy") -> str:
+def store_in_tts_cache(text: str, voice: str, output_path: Path) -> None:
     """
-    Синтезирует речь для заданного текста и диктора.
+    Кладёт готовый mp3 в кэш. Пишем через временный файл, чтобы оборванная запись
+    не оставила в кэше битый файл. Ошибки кэша не должны ронять пайплайн.
+    """
+    cache_path = _tts_cache_path(text, voice)
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path.unlink(missing_ok=True)
+        _link_or_copy(output_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
 
-    - Проверяет наличие OPENAI_API_KEY
-    - Создаёт папку audio в корне проекта
-    - Генерирует имя файла вида 001_speaker.mp3
-    - Вызывает OpenAI TTS (gpt-4o-mini-tts) и сохраняет результат
-    - Возвращает путь к файлу как строку
+
+def _restore_cached(text: str, voice: str, output_path: Path) -> bool:
+    """
+    Ставит на место output_path уже озвученный текст: из памяти, иначе из кэша на диске.
+    Возвращает True при попадании.
     """
-    # Проверяем, что ключ API доступен в переменных окружения.
-    if not os.getenv("OPENAI_API_KEY"):
-        raise RuntimeError(
-            "Не найден OPENAI_API_KEY. Создайте файл .env в корне проекта и добавьте строку "
-            "OPENAI_API_KEY=ваш_ключ (или задайте переменную окружения OPENAI_API_KEY)."
-        )
+    data = get_from_tts_memo(text, voice)
+    if data is not None:
+        write_audio_file(output_path, data)
+        return True
+    return restore_from_tts_cache(text, voice, output_path)
 
-    # Убеждаемся, что папка audio существует.
-    AUDIO_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Формируем упрощённое имя диктора и имя файла с ведущими нулями для индекса хода.
-    speaker_simplified = _simplify_speaker_name(speaker)
-    filename = f"{turn_index:03d}_{speaker_simplified}.mp3"
-    output_path = AUDIO_DIR / filename
+def _store_cached(text: str, voice: str, output_path: Path, data: bytes) -> None:
+    put_in_tts_memo(text, voice, data)
+    store_in_tts_cache(text, voice, output_path)
+
+
+@with_retry
+async def _fetch_speech(text: str, voice: str) -> bytes:
+    # Запрашиваем синтез речи в OpenAI TTS и собираем mp3 из потока в память.
+    async with async_client.audio.speech.with_streaming_response.create(
+        model=TTS_MODEL,
+        voice=voice,
+        input=text,
+        response_format="mp3",
+    ) as response:
+        return b"".join([chunk async for chunk in response.iter_bytes()])
 
-    # Запрашиваем синтез речи в OpenAI TTS.
-    # Используем потоковый ответ и сохраняем напрямую в файл.
+
+@with_retry
+def _fetch_speech_sync(text: str, voice: str) -> bytes:
     with client.audio.speech.with_streaming_response.create(
-        model="gpt-4o-mini-tts",
+        model=TTS_MODEL,
         voice=voice,
         input=text,
         response_format="mp3",
     ) as response:
-        # Сохраняем аудио в mp3-файл.
-        response.stream_to_file(output_path)
+        return b"".join(response.iter_bytes())
+
+
+async def _fetch_speech_coalesced(text: str, voice: str) -> Tuple[bytes, bool]:
+    """
+    Одинаковые тексты, запрошенные одновременно, озвучиваются одним запросом.
+    Возвращает (mp3, is_owner): is_owner истинно только у вызова, создавшего запрос, —
+    он один кладёт результат в кэши (см. synthesize_to_file).
+    """
+    key = (voice, text)
+    task = _tts_inflight.get(key)
+    is_owner = task is None
+    if is_owner:
+        task = asyncio.ensure_future(_fetch_speech(text, voice))
+        _tts_inflight[key] = task
+        task.add_done_callback(lambda _: _tts_inflight.pop(key, None))
+    data = await task
+    return data, is_owner
+
+
+async def synthesize_to_file(
+    text: str,
+    output_path: Path,
+    voice: str,
+    use_cache: bool = True,
+) -> Path:
+    """
+    Озвучивает текст в заданный mp3-файл:
+    - из памяти, если этот текст уже озвучивался в этом запуске
+    - из кэша на диске, если он озвучивался в прошлых запусках
+    - иначе через OpenAI TTS
+    Кэши (память и диск) — только при use_cache, т.е. для фиксированных текстов.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if use_cache and _restore_cached(text, voice, output_path):
+        return output_path
+
+    ensure_api_key()
+    data, is_owner = await _fetch_speech_coalesced(text, voice)
+    write_audio_file(output_path, data)
+
+    if use_cache and is_owner:
+        _store_cached(text, voice, output_path, data)
+    return output_path
+
+
+def synthesize_to_file_sync(
+    text: str,
+    output_path: Path,
+    voice: str,
+    use_cache: bool = True,
+) -> Path:
+    """
+    Синхронный вариант synthesize_to_file (для video_engine) с теми же кэшами.
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if use_cache and _restore_cached(text, voice, output_path):
+        return output_path
+
+    ensure_api_key()
+    data = _fetch_speech_sync(text, voice)
+    write_audio_file(output_path, data)
+
+    if use_cache:
+        _store_cached(text, voice, output_path, data)
+    return output_path
+
+
+async def synthesize_speech(
+    text: str,
+    speaker: str,
+    turn_index: int,
+    voice: str = "alloy",
+    sentence_index: Optional[int] = None,
+    use_cache: bool = False,
+) -> str:
+    """
+    Синтезирует речь для заданного текста и диктора.
+
+    - Генерирует имя файла вида 001_speaker.mp3 (или 001_02_speaker.mp3 для отдельного предложения)
+    - Озвучивает текст в этот файл в папке audio (см. synthesize_to_file);
+      кэши — только если текст фиксированный (use_cache)
+    - Возвращает путь к файлу как строку
+    """
+    # Формируем упрощённое имя диктора и имя файла с ведущими нулями для индекса хода
+    # (и, если задан, индекса предложения внутри хода).
+    speaker_simplified = _simplify_speaker_name(speaker)
+    if sentence_index is None:
+        filename = f"{turn_index:03d}_{speaker_simplified}.mp3"
+    else:
+        filename = f"{turn_index:03d}_{sentence_index:02d}_{speaker_simplified}.mp3"
+    output_path = AUDIO_DIR / filename
+
+    await synthesize_to_file(
+        text=text,
+        output_path=output_path,
+        voice=voice,
+        use_cache=use_cache,
+    )
 
     # Возвращаем путь к файлу в виде строки.
     return str(output_path)
@@ -1,17 +1,15 @@
 from __future__ import annotations
 
 import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Tuple
-
-from openai import OpenAI
-from moviepy.editor import (
-    AudioFileClip,
-    ColorClip,
-    CompositeVideoClip,
-    ImageClip,
-    concatenate_videoclips,
-)
+from typing import List, Optional, Tuple
+
+from mutagen.mp3 import MP3
+
+from env_loader import load_dotenv_once
+from tts_engine import synthesize_to_file_sync
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 AUDIO_DIR = PROJECT_ROOT / "audio"
@@ -23,40 +21,41 @@ ASSETS_DIR = PROJECT_ROOT / "assets"
 OUTPUT_PATH = VIDEO_DIR / "dialog_test.mp4"
 
 RESOLUTION: Tuple[int, int] = (1280, 720)
-BG_COLOR = (17, 17, 17)  # #111111
+BG_COLOR = "0x111111"  # #111111
+FPS = 24
+# Потоков на один процесс ffmpeg: сегменты кодируются параллельно, поэтому не даём каждому занять все ядра.
+FFMPEG_THREADS = 2
+
+# Картинка по центру, без растяжения, пропорции сохранены, поля залиты фоном.
+_FIT_ON_BG_FILTER = (
+    f"scale={RESOLUTION[0]}:{RESOLUTION[1]}:force_original_aspect_ratio=decrease,"
+    f"pad={RESOLUTION[0]}:{RESOLUTION[1]}:(ow-iw)/2:(oh-ih)/2:color={BG_COLOR},"
+    "setsar=1"
+)
+
+# Сегмент = (картинка или None для пустого фона, аудио, длительность аудио в секундах, выходной mp4)
+Segment = Tuple[Optional[Path], Path, float, Path]
 
 # Голоса: интро и представления - голос, отличный от спикеров
 NEUTRAL_VOICE = "onyx"
-TTS_MODEL = "gpt-4o-mini-tts"
 
 
-def _load_dotenv_if_present(dotenv_name: str = ".env") -> None:
+def _find_ffmpeg() -> str:
     """
-    Минималистичный загрузчик .env:
-    - ищет .env в корне проекта
-    - не перезаписывает уже выставленные переменные окружения
+    ffmpeg из imageio-ffmpeg (ставится через requirements.txt), иначе — из PATH.
     """
-    env_path = PROJECT_ROOT / dotenv_name
-    if not env_path.exists():
-        return
-
     try:
-        with env_path.open("r", encoding="utf-8") as f:
-            for raw_line in f:
-                line = raw_line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                key, value = line.split("=", 1)
-                key = key.strip()
-                value = value.strip().strip('"').strip("'")
-                if key and key not in os.environ:
-                    os.environ[key] = value
-    except OSError:
-        return
+        import imageio_ffmpeg
 
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
 
-_load_dotenv_if_present()
-client = OpenAI()
+
+FFMPEG_BIN = _find_ffmpeg()
+
+
+load_dotenv_once()
 
 # Тема берётся из env 
 TOPIC = os.getenv(
@@ -72,7 +71,51 @@ def _env_int(name: str, default: int) -> int:
         return default
 
 
-MAX_AUDIO_FILES = _env_int("MAX_AUDIO_FILES", 0)  # 0 = без ограничения
+MAX_AUDIO_FILES = _env_int("MAX_AUDIO_FILES", 0)  # число реплик в видео, 0 = без ограничения
+
+
+# Тексты интро зависят только от темы, поэтому main.py озвучивает их заранее,
+# параллельно с генерацией диалога (см. intro_audio_jobs).
+SPEAKER_INTROS = {
+    "irina": ("Ирина — учёный и исследователь. Она поможет разобраться в теме.", "010_intro_irina.mp3"),
+    "alexey": (
+        "Алексей — собеседник, который задаёт неудобные вопросы и проверяет аргументы.",
+        "011_intro_alexey.mp3",
+    ),
+}
+UNKNOWN_SPEAKER_INTRO = ("Участник диалога.", "012_intro_unknown.mp3")
+
+
+def topic_intro_text(topic: str) -> str:
+    # Чтобы интро соответствовало теме, можно озвучить сам topic.
+    # Но чтобы не рисковать латиницей/странными символами, делаем нейтральную вводную + тема одной фразой.
+    return (
+        "Сегодня мы обсуждаем научную тему. "
+        f"Тема выпуска: {topic}"
+    )
+
+
+def intro_audio_jobs(topic: str) -> List[Tuple[str, Path]]:
+    """
+    Все интро-фразы выпуска: (текст, mp3-файл). Озвучиваются голосом NEUTRAL_VOICE.
+    """
+    jobs = [(topic_intro_text(topic), TMP_DIR / "000_topic_intro.mp3")]
+    for text, fname in SPEAKER_INTROS.values():
+        jobs.append((text, TMP_DIR / fname))
+    return jobs
+
+
+def _audio_sort_key(filename: str) -> Tuple[int, ...]:
+    """
+    Ключ сортировки реплик: числовые префиксы имени файла
+    (001_ирина.mp3 -> (1,), 001_02_ирина.mp3 -> (1, 2)).
+    """
+    key: List[int] = []
+    for part in filename.split("_"):
+        if not part.isdigit():
+            break
+        key.append(int(part))
+    return tuple(key)
 
 
 def detect_speaker_from_filename(filename: str) -> str:
@@ -84,45 +127,81 @@ def detect_speaker_from_filename(filename: str) -> str:
     return "unknown"
 
 
-def _tts_to_file(text: str, out_path: Path, voice: str) -> Path:
-    out_path.parent.mkdir(parents=True, exist_ok=True)
+def _audio_duration(audio_path: Path) -> float:
+    """
+    Длительность mp3 по заголовкам фреймов — без запуска ffmpeg.
+    """
+    return MP3(str(audio_path)).info.length
 
-    if not os.getenv("OPENAI_API_KEY"):
-        raise RuntimeError(
-            "Не найден OPENAI_API_KEY. Создайте файл .env в корне проекта и добавьте строку "
-            "OPENAI_API_KEY=ваш_ключ (или задайте переменную окружения OPENAI_API_KEY)."
-        )
 
-    with client.audio.speech.with_streaming_response.create(
-        model=TTS_MODEL,
-        voice=voice,
-        input=text,
-        response_format="mp3",
-    ) as response:
-        response.stream_to_file(out_path)
+def encode_segment(segment: Segment) -> Path:
+    """
+    Кодирует один сегмент видео: статичная картинка (или фон #111111) + аудио.
+    Все сегменты получают одинаковые параметры кодека, поэтому потом склеиваются без перекодирования.
+    """
+    image_path, audio_path, duration, out_path = segment
+    w, h = RESOLUTION
 
+    if image_path is not None:
+        video_input = ["-loop", "1", "-framerate", str(FPS), "-i", str(image_path)]
+    else:
+        video_input = ["-f", "lavfi", "-i", f"color=c={BG_COLOR}:s={w}x{h}:r={FPS}"]
+
+    cmd = [
+        FFMPEG_BIN,
+        "-y",
+        "-hide_banner",
+        "-loglevel", "error",
+        *video_input,
+        "-i", str(audio_path),
+        "-map", "0:v",
+        "-map", "1:a",
+        "-vf", _FIT_ON_BG_FILTER,
+        "-c:v", "libx264",
+        "-tune", "stillimage",
+        "-pix_fmt", "yuv420p",
+        "-r", str(FPS),
+        "-threads", str(FFMPEG_THREADS),
+        "-c:a", "aac",
+        "-ar", "44100",
+        "-ac", "2",
+        "-t", f"{duration:.3f}",
+        str(out_path),
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {proc.returncode}: {proc.stderr.strip()}")
     return out_path
 
 
-def _fit_image_on_bg(image_path: Path, duration: float) -> CompositeVideoClip:
+def _concat_segments(segment_paths: List[Path], out_path: Path) -> None:
     """
-    Фон #111111, картинка по центру, без растяжения, пропорции сохранены.
+    Склейка готовых сегментов concat-демультиплексором ffmpeg без перекодирования.
     """
-    bg = ColorClip(size=RESOLUTION, color=BG_COLOR).set_duration(duration)
-
-    img = ImageClip(str(image_path)).set_duration(duration)
-    w, h = img.size
-    rw, rh = RESOLUTION
-
-    scale = min(rw / w, rh / h)
-    new_w = int(w * scale)
-    new_h = int(h * scale)
-
-    img = img.resize(newsize=(new_w, new_h)).set_position(("center", "center"))
-    return CompositeVideoClip([bg, img], size=RESOLUTION).set_duration(duration)
-
-
-def _make_cover_bg(duration: float) -> CompositeVideoClip:
+    list_path = TMP_DIR / "concat.txt"
+    with list_path.open("w", encoding="utf-8") as f:
+        for p in segment_paths:
+            escaped = str(p.resolve()).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+    cmd = [
+        FFMPEG_BIN,
+        "-y",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", str(list_path),
+        "-c", "copy",
+        "-movflags", "+faststart",
+        str(out_path),
+    ]
+    proc = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg завершился с кодом {proc.returncode}: {proc.stderr.strip()}")
+
+
+def _cover_image() -> Optional[Path]:
     """
     Фон для ведущего assets/cover.png на всём экране.
     Если cover.png нет — используем просто тёмный фон, но не падаем.
@@ -130,75 +209,39 @@ def _make_cover_bg(duration: float) -> CompositeVideoClip:
     cover_path = ASSETS_DIR / "cover.png"
     if not cover_path.exists():
         print(f"[COVER][WARN] Не найден файл: {cover_path} — будет использован тёмный фон.")
-        return ColorClip(size=RESOLUTION, color=BG_COLOR).set_duration(duration)
-
-    # Используем ту же посадку (без растяжения), чтобы не ломать пропорции.
-    return _fit_image_on_bg(image_path=cover_path, duration=duration)
+        return None
+    return cover_path
 
 
-def make_topic_intro_clip(topic: str) -> CompositeVideoClip:
+def make_topic_intro_segment(topic: str, out_path: Path) -> Segment:
     """
-    Общее голосовое интро темы, длительность = длине аудио.
+    Общее голосовое интро темы на фоне cover.png, длительность = длине аудио.
     """
     print("[INTRO] Добавляем интро темы...")
 
-    # Чтобы интро соответствовало теме, можно озвучить сам topic.
-    # Но чтобы не рисковать латиницей/странными символами, делаем нейтральную вводную + тема одной фразой.
-    text = (
-        "Сегодня мы обсуждаем научную тему. "
-        f"Тема выпуска: {topic}"
-    )
-
-    audio_path = _tts_to_file(
-        text=text,
-        out_path=TMP_DIR / "000_topic_intro.mp3",
+    # Интро обычно уже озвучены заранее (main.py) или в прошлых запусках — тогда берутся из кэша
+    audio_path = synthesize_to_file_sync(
+        text=topic_intro_text(topic),
+        output_path=TMP_DIR / "000_topic_intro.mp3",
         voice=NEUTRAL_VOICE,
     )
+    return _cover_image(), audio_path, _audio_duration(audio_path), out_path
 
-    audio = AudioFileClip(str(audio_path))
-    duration = audio.duration
-
-    bg = _make_cover_bg(duration).set_audio(audio)
-    return bg
 
-
-def make_speaker_intro_clip(speaker_key: str, avatar_path: Path) -> CompositeVideoClip:
+def make_speaker_intro_segment(speaker_key: str, out_path: Path) -> Segment:
     """
     Голосовое представление спикера на фоне cover.png
     """
-    if speaker_key == "irina":
-        text = "Ирина — учёный и исследователь. Она поможет разобраться в теме."
-        fname = "010_intro_irina.mp3"
-    elif speaker_key == "alexey":
-        text = "Алексей — собеседник, который задаёт неудобные вопросы и проверяет аргументы."
-        fname = "011_intro_alexey.mp3"
-    else:
-        text = "Участник диалога."
-        fname = "012_intro_unknown.mp3"
+    text, fname = SPEAKER_INTROS.get(speaker_key, UNKNOWN_SPEAKER_INTRO)
 
     print(f"[INTRO] Добавляем представление спикера: {speaker_key}...")
 
-    audio_path = _tts_to_file(
+    audio_path = synthesize_to_file_sync(
         text=text,
-        out_path=TMP_DIR / fname,
+        output_path=TMP_DIR / fname,
         voice=NEUTRAL_VOICE,
     )
-
-    audio = AudioFileClip(str(audio_path))
-    duration = audio.duration
-
-    bg = _make_cover_bg(duration).set_audio(audio)
-    return bg
-
-
-def make_avatar_clip(image_path: Path, audio_path: Path) -> CompositeVideoClip:
-    """
-    Реплика диалога: аватар (без растяжения) + аудио реплики.
-    """
-    audio = AudioFileClip(str(audio_path))
-    duration = audio.duration
-    clip = _fit_image_on_bg(image_path=image_path, duration=duration).set_audio(audio)
-    return clip
+    return _cover_image(), audio_path, _audio_duration(audio_path), out_path
 
 
 def main() -> None:
@@ -210,14 +253,20 @@ def main() -> None:
 
     VIDEO_DIR.mkdir(parents=True, exist_ok=True)
     TMP_DIR.mkdir(parents=True, exist_ok=True)
+    segments_dir = TMP_DIR / "segments"
+    segments_dir.mkdir(parents=True, exist_ok=True)
 
     # Берём все реплики диалога (mp3 с ведущими цифрами в имени)
-    audio_files: List[Path] = sorted(AUDIO_DIR.glob("*.mp3"))
-    audio_files = [p for p in audio_files if p.name[:3].isdigit()]
-    audio_files = sorted(audio_files, key=lambda p: p.name)
+    entries = [
+        e for e in os.scandir(AUDIO_DIR) if e.name.endswith(".mp3") and e.name[:3].isdigit()
+    ]
+    entries.sort(key=lambda e: _audio_sort_key(e.name))
+    audio_files: List[Path] = [Path(e.path) for e in entries]
 
     if MAX_AUDIO_FILES and MAX_AUDIO_FILES > 0:
-        audio_files = audio_files[:MAX_AUDIO_FILES]
+        # Реплика озвучена несколькими файлами (по предложению) — ограничиваем число реплик, а не файлов
+        kept_turns = sorted({_audio_sort_key(p.name)[0] for p in audio_files})[:MAX_AUDIO_FILES]
+        audio_files = [p for p in audio_files if _audio_sort_key(p.name)[0] in kept_turns]
 
     if not audio_files:
         print(f"[ERROR] Не найдено ни одного аудиофайла в {AUDIO_DIR}")
@@ -238,11 +287,14 @@ def main() -> None:
             print(f"[ERROR] Не найден аватар для {k}: {path}")
             return
 
-    clips = []
+    segments: List[Segment] = []
+
+    def next_segment_path() -> Path:
+        return segments_dir / f"{len(segments):03d}.mp4"
 
     # Общее интро темы (1 раз), на фоне cover.png
     try:
-        clips.append(make_topic_intro_clip(TOPIC))
+        segments.append(make_topic_intro_segment(TOPIC, next_segment_path()))
         print("[OK] Интро темы добавлено.")
     except Exception as e:
         print(f"[ERROR] Не удалось создать интро темы: {e}")
@@ -264,9 +316,7 @@ def main() -> None:
 
         # логи длительности реплики
         try:
-            a = AudioFileClip(str(audio_path))
-            duration = a.duration
-            a.close()
+            duration = _audio_duration(audio_path)
         except Exception as e:
             print(f"[ERROR] Не удалось прочитать аудио {audio_path.name}: {e}")
             continue
@@ -275,57 +325,49 @@ def main() -> None:
             f"[STEP {idx}] Реплика: {audio_path.name} | Спикер: {speaker_key} | Длительность: {duration:.2f} сек"
         )
 
-        # если спикер ещё не представлен — добавляем интро-clip
+        # если спикер ещё не представлен — добавляем интро-сегмент
         if speaker_key in introduced and not introduced[speaker_key]:
             try:
-                intro_clip = make_speaker_intro_clip(speaker_key, avatar_path)
-                clips.append(intro_clip)
+                segments.append(make_speaker_intro_segment(speaker_key, next_segment_path()))
                 introduced[speaker_key] = True
                 print(f"[OK] Представление {speaker_key} добавлено.")
             except Exception as e:
                 print(f"[ERROR] Не удалось создать представление спикера {speaker_key}: {e}")
                 return
 
-        # Реплика диалога (голос спикера уже в mp3)
-        try:
-            clip = make_avatar_clip(image_path=avatar_path, audio_path=audio_path)
-            clips.append(clip)
-        except Exception as e:
-            print(f"[ERROR] Не удалось создать клип реплики для {audio_path.name}: {e}")
+        # Реплика диалога (голос спикера уже в mp3): аватар + аудио реплики
+        segments.append((avatar_path, audio_path, duration, next_segment_path()))
 
-    if not clips:
-        print("[ERROR] Не удалось создать ни одного клипа — выход.")
-        return
-
-    final_clip = concatenate_videoclips(clips, method="compose")
-
-    print(f"Сохраняем итоговое видео в {OUTPUT_PATH} ...")
+    # Сегменты независимы — кодируем их параллельно, склейка остаётся одним последовательным шагом.
+    max_workers = max(1, (os.cpu_count() or 2) // 2)
+    print(f"Кодируем сегменты: {len(segments)} шт., процессов: {max_workers} ...")
 
+    encoded: List[Path] = []
     try:
-        final_clip.write_videofile(
-            str(OUTPUT_PATH),
-            codec="libx264",
-            audio_codec="aac",
-            fps=24,
-        )
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(encode_segment, segment) for segment in segments]
+            for segment, future in zip(segments, futures):
+                try:
+                    encoded.append(future.result())
+                except RuntimeError as e:
+                    print(f"[ERROR] Не удалось создать сегмент для {segment[1].name}: {e}")
+
+        if not encoded:
+            print("[ERROR] Не удалось создать ни одного сегмента — выход.")
+            return
+
+        print(f"Сохраняем итоговое видео в {OUTPUT_PATH} ...")
+        _concat_segments(encoded, OUTPUT_PATH)
         print(f"[OK] Итоговый файл сохранён: {OUTPUT_PATH}")
-    except Exception as e:
-        msg = str(e).lower()
+    except (OSError, RuntimeError) as e:
         print(f"[ERROR] Не удалось сохранить видео: {e}")
-        if "ffmpeg" in msg:
+        if isinstance(e, FileNotFoundError):
             print(
                 "\nПохоже, ffmpeg недоступен.\n"
                 "Установите ffmpeg и убедитесь, что он есть в PATH.\n"
                 "Пример (Windows, через choco): choco install ffmpeg\n"
                 "И перезапустите: python src/video_engine.py"
             )
-    finally:
-        final_clip.close()
-        for c in clips:
-            try:
-                c.close()
-            except Exception:
-                pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import sys
+import unittest
+from pathlib import Path
+
+# Модули проекта лежат в src/ и импортируются по имени (как в src/main.py).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from sentence_splitter import split_sentences  # noqa: E402
+
+
+class SplitSentencesTest(unittest.TestCase):
+    def test_splits_on_sentence_boundary(self):
+        complete, rest = split_sentences("Органы стареют по-разному. Почему так? Это")
+        self.assertEqual(complete, ["Органы стареют по-разному.", "Почему так?"])
+        self.assertEqual(rest, "Это")
+
+    def test_abbreviations_do_not_split(self):
+        text = "Органы стареют по-разному, т. е. с разной скоростью. Дальше"
+        complete, rest = split_sentences(text)
+        self.assertEqual(complete, ["Органы стареют по-разному, т. е. с разной скоростью."])
+        self.assertEqual(rest, "Дальше")
+
+    def test_initials_do_not_split(self):
+        complete, rest = split_sentences("Ещё И. И. Мечников об этом писал. Но")
+        self.assertEqual(complete, ["Ещё И. И. Мечников об этом писал."])
+        self.assertEqual(rest, "Но")
+
+    def test_waits_for_next_token_after_period(self):
+        complete, rest = split_sentences("Органы стареют по-разному, т. ")
+        self.assertEqual(complete, [])
+        self.assertEqual(rest, "Органы стареют по-разному, т. ")
+
+    def test_newline_is_boundary(self):
+        complete, rest = split_sentences("Первая мысль\nвторая")
+        self.assertEqual(complete, ["Первая мысль"])
+        self.assertEqual(rest, "вторая")
+
+
+if __name__ == "__main__":
+    unittest.main()